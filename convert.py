@@ -10,141 +10,255 @@ Usage: Add this script to OrcaSlicer's post-processing scripts.
 
 import sys
 import os
-from typing import Tuple
+import mmap
+import re
+import itertools
+import shutil
+from typing import Dict, List, Pattern, Tuple, Union
 
 # ---------------- CONFIG ----------------
 enable_spaghetti_detector = True  # Enable/Disable the spaghetti detector (default: True)
 # ----------------------------------------
 
-def extract_sections(gcode_content: str) -> Tuple[str, str, str, str, str]:
+# Metadata fields to explicitly look for, as one alternation matched at the start
+# of a line: filament used [mm]/[cm3]/[g], filament cost, total filament used [g],
+# total filament cost, total layers count and estimated printing time (normal mode)
+METADATA_PATTERN = (
+    rb"; (?:filament used \[(?:mm|cm3|g)\]|filament cost"
+    rb"|total filament (?:used \[g\]|cost)|total layers count"
+    rb"|estimated printing time \(normal mode\))"
+)
+METADATA_RE = re.compile(rb"^" + METADATA_PATTERN, re.MULTILINE)
+
+# A "; " comment line containing OrcaSlicer's filament start/end gcode marker (any case)
+SPAGHETTI_MARKER_PATTERN = rb"(?=; )[^\n]*?(?i:; filament (?:(?P<start>start)|end) gcode)"
+
+# The start sentinel line of a HEADER/CONFIG/THUMBNAIL block. Its end sentinel
+# is then located with a plain substring find(), see find_block_end().
+BLOCK_START_RE = re.compile(
+    rb"^; (HEADER|CONFIG|THUMBNAIL)_BLOCK_START[ \t\r\f\v]*$",
+    re.MULTILINE
+)
+
+# A section is kept as the list of its pieces, which are joined with newlines
+# only when written. Most pieces are memoryview slices of the input file.
+Section = List[Union[bytes, memoryview]]
+
+# Any non-whitespace byte; searched directly in memoryviews without copying
+NON_WHITESPACE_RE = re.compile(rb"\S")
+
+# Maximum number of buffers per writev() call (IOV_MAX on Linux and macOS)
+IOV_MAX = 1024
+
+# Spaghetti detector commands, wrapped around each filament's start/end gcode
+SPAGHETTI_DETECTOR_ON = b"M981 S1 P20000 ; Enable spaghetti detector"
+SPAGHETTI_DETECTOR_OFF = b"M981 S0 P20000 ; Disable spaghetti detector"
+
+def compile_body_line_res(spaghetti_detector: bool) -> Tuple[Pattern, Pattern]:
     """
-    Extract different sections from the G-code file
-    Returns: (header_block, thumbnail_block, executable_gcode, metadata, config_block)
+    Compile the patterns for the body lines split_body() has to act on: metadata,
+    plus the spaghetti detector markers only when the detector is enabled, so a
+    disabled detector costs nothing at all during the scan.
+    Returns (line_re, next_line_re); the first matches a line at the given offset,
+    the second the next such line after a newline, which gives the regex engine
+    a literal prefix to search for.
     """
+    line = rb"(?P<line>(?P<metadata>" + METADATA_PATTERN + rb")"
+    if spaghetti_detector:
+        line += rb"|" + SPAGHETTI_MARKER_PATTERN
+    line += rb")"
+    return re.compile(line), re.compile(rb"\n" + line)
 
-    lines = gcode_content.split('\n')
+# Body line patterns, specialised once for each spaghetti detector setting
+BODY_LINE_RES: Dict[bool, Tuple[Pattern, Pattern]] = {
+    False: compile_body_line_res(False),
+    True: compile_body_line_res(True),
+}
 
-    header_block = []
-    thumbnail_block = []
-    config_block = []
-    metadata = []
-    executable_gcode = []
+def find_block_end(content: bytes, name: bytes, pos: int) -> int:
+    """
+    Find the line "; <name>_BLOCK_END" after pos and return the offset where
+    that line ends, or -1 if the block is never closed.
 
-    # Simple boolean flags for tracking sections
-    in_header = False
-    in_config = False
-    in_thumbnail = False
-    collecting_metadata = True
-
-    # Metadata fields to explicitly look for
-    metadata_fields = [
-        "; filament used [mm]", "; filament used [cm3]", "; filament used [g]",
-        "; filament cost", "; total filament used [g]", "; total filament cost",
-        "; total layers count", "; estimated printing time (normal mode)"
-    ]
-
-    for line in lines:
-        stripped = line.strip()
-
-        # CONFIG block detection
-        if stripped == "; CONFIG_BLOCK_START":
-            in_config = True
-            config_block.append(line)
-            continue
-        elif stripped == "; CONFIG_BLOCK_END":
-            config_block.append(line)
-            in_config = False
-            continue
-        elif in_config:
-            config_block.append(line)
-            continue
+    find() rejects the base64 thumbnail lines in C, several bytes at a time,
+    instead of testing each line of the block for the sentinel.
+    """
+    sentinel = b"\n; " + name + b"_BLOCK_END"
+    while True:
+        found = content.find(sentinel, pos)
+        if found < 0:
+            return -1
+        line_end = content.find(b'\n', found + 1)
+        if line_end < 0:
+            line_end = len(content)
+        # Only trailing whitespace may follow the sentinel on its line
+        if not content[found + len(sentinel):line_end].strip():
+            return line_end
+        pos = found + 1
 
-        # HEADER block detection
-        if stripped == "; HEADER_BLOCK_START":
-            in_header = True
-            header_block.append(line)
-            continue
-        elif stripped == "; HEADER_BLOCK_END":
-            header_block.append(line)
-            in_header = False
-            continue
-        elif in_header:
-            header_block.append(line)
-            continue
+def split_body(content: bytes, start: int, end: int, metadata: Section, executable_gcode: Section,
+               body_line_res: Tuple[Pattern, Pattern]):
+    """
+    Split the lines of content[start:end], which lies outside any block,
+    into metadata and executable gcode. An empty range (end < start) has no lines.
+    With the spaghetti detector patterns from BODY_LINE_RES, M981 commands are
+    inserted around OrcaSlicer's '; filament start gcode' and '; filament end gcode'
+    comments in the same pass.
 
-        # THUMBNAIL block detection
-        if stripped == "; THUMBNAIL_BLOCK_START":
-            in_thumbnail = True
-            thumbnail_block.append(line)
-            continue
-        elif stripped == "; THUMBNAIL_BLOCK_END":
-            thumbnail_block.append(line)
-            in_thumbnail = False
-            continue
-        elif in_thumbnail:
-            thumbnail_block.append(line)
-            continue
+    The regex engine finds the few lines to act on, so the moves in between are
+    never visited from Python. The executable gcode is collected as multi-line
+    memoryview slices of content, recorded by offset rather than copied.
+    """
+    if end < start:
+        return
+
+    # Globals and bound methods are cached in locals for the per-match loop
+    find = content.find
+    view = memoryview(content)
+    append_executable = executable_gcode.append
+    append_metadata = metadata.append
+    line_re, next_line_re = body_line_res
 
-        # Metadata collection (before CONFIG_BLOCK_START)
-        if collecting_metadata:
-            if any(field in stripped for field in metadata_fields):
-                metadata.append(line)
-                continue
-            elif stripped == "; CONFIG_BLOCK_START":
-                collecting_metadata = False
+    if start:
+        # The newline ending the preceding block introduces the first line
+        matches = next_line_re.finditer(content, start - 1, end)
+    else:
+        first = line_re.match(content, 0, end)
+        matches = itertools.chain([first] if first else [], next_line_re.finditer(content, 0, end))
 
-        # Everything else goes to executable gcode
-        executable_gcode.append(line)
+    # Start of the executable lines not yet copied into executable_gcode
+    run_start = start
+
+    for match in matches:
+        line_start = match.start('line')
+        if line_start > run_start:
+            append_executable(view[run_start:line_start - 1])
+
+        # Metadata lines are moved out of the body wherever they appear
+        if match.start('metadata') >= 0:
+            line_end = find(b'\n', line_start, end)
+            if line_end < 0:
+                line_end = end
+            append_metadata(view[line_start:line_end])
+            run_start = line_end + 1
+        else:
+            if match.start('start') >= 0:
+                append_executable(SPAGHETTI_DETECTOR_ON)
+            else:
+                append_executable(SPAGHETTI_DETECTOR_OFF)
+            run_start = line_start
+
+    if run_start <= end:
+        append_executable(view[run_start:end])
+
+def extract_sections(content: bytes, spaghetti_detector: bool) -> Tuple[Section, Section, Section, Section, Section]:
+    """
+    Extract different sections from the raw G-code (bytes or a mmap),
+    optionally inserting the spaghetti detector commands into the executable gcode.
+    Sections stay raw bytes: G-code and base64 thumbnails are ASCII, so there is nothing to decode.
+    Each section is a list of pieces to be joined with newlines; most pieces are
+    memoryviews into content, so content must outlive the returned sections.
+    Returns: (header_block, thumbnail_block, executable_gcode, metadata, config_block)
+    """
+
+    view = memoryview(content)
+    body_line_res = BODY_LINE_RES[bool(spaghetti_detector)]
+    blocks = {b"HEADER": [], b"THUMBNAIL": [], b"CONFIG": []}
+    metadata = []
+    executable_gcode = []
+
+    # Blocks are sliced out whole; only the text between them is split into lines.
+    # A block spans its sentinel lines, so the text between two blocks starts
+    # after the newline ending one and stops before the newline preceding the next.
+    body_start = 0
+    pos = 0
+    while True:
+        match = BLOCK_START_RE.search(content, pos)
+        if match is None:
+            break
+        block_end = find_block_end(content, match.group(1), match.end())
+        if block_end < 0:
+            # Unterminated block: leave its start line in the body
+            pos = match.end()
+            continue
+
+        blocks[match.group(1)].append(view[match.start():block_end])
+        split_body(content, body_start, match.start() - 1, metadata, executable_gcode, body_line_res)
+        body_start = pos = block_end + 1
+    split_body(content, body_start, len(content), metadata, executable_gcode, body_line_res)
 
     return (
-        '\n'.join(header_block),
-        '\n'.join(thumbnail_block),
-        '\n'.join(executable_gcode),
-        '\n'.join(metadata),
-        '\n'.join(config_block)
+        blocks[b"HEADER"],
+        blocks[b"THUMBNAIL"],
+        executable_gcode,
+        metadata,
+        blocks[b"CONFIG"]
     )
 
-def add_spaghetti_detector(executable_gcode: str) -> str:
+def has_content(section: Section) -> bool:
+    """Whether any piece of the section holds something other than whitespace."""
+    return any(NON_WHITESPACE_RE.search(piece) for piece in section)
+
+def write_buffers(fd: int, buffers: Section):
     """
-    Insert M981 commands for spaghetti detector if enabled.
-    Looks for OrcaSlicer comments like '; filament start gcode' and '; filament end gcode'.
+    Write buffers to fd in order using scatter-gather os.writev() where available,
+    falling back to one os.write() per buffer (e.g. on Windows).
+    Handles partial writes and the per-call IOV_MAX limit.
     """
-    if not enable_spaghetti_detector:
-        return executable_gcode
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
 
-    lines = executable_gcode.split('\n')
-    new_lines = []
+    if not hasattr(os, 'writev'):
+        for view in views:
+            while view:
+                view = view[os.write(fd, view):]
+        return
 
-    for line in lines:
-        stripped = line.strip().lower()
+    i = 0
+    while i < len(views):
+        written = os.writev(fd, views[i:i + IOV_MAX])
+        # Drop the buffers that were written completely, trim a partial one
+        while i < len(views) and written >= len(views[i]):
+            written -= len(views[i])
+            i += 1
+        if written:
+            views[i] = views[i][written:]
 
-        if "; filament start gcode" in stripped:
-            new_lines.append("M981 S1 P20000 ; Enable spaghetti detector")
-        elif "; filament end gcode" in stripped:
-            new_lines.append("M981 S0 P20000 ; Disable spaghetti detector")
+def fadvise(fd: int, advice: str):
+    """Give the kernel a posix_fadvise() hint for the whole file, where supported."""
+    if hasattr(os, 'posix_fadvise') and hasattr(os, advice):
+        try:
+            os.posix_fadvise(fd, 0, 0, getattr(os, advice))
+        except OSError:
+            pass
 
-        new_lines.append(line)
+def drop_cached_pages(path: str):
+    """Let the kernel drop the file's cached pages, where posix_fadvise() is supported."""
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        fadvise(fd, 'POSIX_FADV_DONTNEED')
+    finally:
+        os.close(fd)
 
-    return '\n'.join(new_lines)
+def detect_line_terminator(content: bytes) -> bytes:
+    """Return the file's line terminator, b'\r\n' or b'\n', judged by its first line."""
+    first_newline = content.find(b'\n')
+    if first_newline > 0 and content[first_newline - 1:first_newline] == b'\r':
+        return b'\r\n'
+    return b'\n'
 
-def restructure_gcode(input_file: str) -> str:
+def write_sections(output_file: str, sections: Tuple[Section, Section, Section, Section, Section],
+                   line_terminator: bytes):
     """
-    Restructure G-code from OrcaSlicer format to Orca-FlashForge format
+    Write the sections returned by extract_sections() to output_file
+    in Orca-FlashForge order, ending lines with line_terminator. Write errors are raised.
     """
-    
-    try:
-        with open(input_file, 'r', encoding='utf-8') as f:
-            content = f.read()
-    except Exception as e:
-        print(f"Error reading file {input_file}: {e}")
-        return None
-    
-    # Extract sections
-    header_block, thumbnail_block, executable_gcode, metadata, config_block = extract_sections(content)
+    header_block, thumbnail_block, executable_gcode, metadata, config_block = sections
 
-    # Optionally add spaghetti detector
-    executable_gcode = add_spaghetti_detector(executable_gcode)
-    
     # Build new structure following Orca-FlashForge format:
     # 1. Header block
     # 2. Metadata (filament usage, ETA, etc.)
@@ -154,26 +268,142 @@ def restructure_gcode(input_file: str) -> str:
     
     restructured_parts = []
     
-    if header_block.strip():
+    if has_content(header_block):
         restructured_parts.append(header_block)
-        restructured_parts.append("")  # spacing
+        restructured_parts.append([b""])  # spacing
     
-    if metadata.strip():
+    if has_content(metadata):
         restructured_parts.append(metadata)
-        restructured_parts.append("")
+        restructured_parts.append([b""])
     
-    if config_block.strip():
+    if has_content(config_block):
         restructured_parts.append(config_block)
-        restructured_parts.append("")
+        restructured_parts.append([b""])
     
-    if thumbnail_block.strip():
+    if has_content(thumbnail_block):
         restructured_parts.append(thumbnail_block)
-        restructured_parts.append("")
+        restructured_parts.append([b""])
     
-    if executable_gcode.strip():
+    if has_content(executable_gcode):
         restructured_parts.append(executable_gcode)
     
-    return '\n'.join(restructured_parts)
+    # Hand the pieces and their separating newlines to the kernel as they are,
+    # so the only copy of the file contents is the one into the output file
+    # Pieces sliced from a CRLF file already end in \r (only the \n between them was
+    # left out), but the blank spacer lines, inserted M981 lines and an unterminated
+    # last line of the input do not, so those get the full terminator
+    crlf = line_terminator == b'\r\n'
+    buffers = []
+    for part in restructured_parts:
+        for piece in part:
+            if buffers:
+                previous = buffers[-1]
+                if crlf and previous[-1:] != b'\r':
+                    buffers.append(b'\r\n')
+                else:
+                    buffers.append(b'\n')
+            buffers.append(piece)
+
+    fd = os.open(output_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        write_buffers(fd, buffers)
+    finally:
+        os.close(fd)
+
+def restructure_gcode_to(input_file: str, output_file: str) -> bool:
+    """
+    Restructure G-code from OrcaSlicer format to Orca-FlashForge format
+    and write it to output_file, which must not be input_file: the output is
+    written straight from memoryviews into the mapped input.
+    Returns False if the input could not be read; write errors are raised.
+    """
+    
+    try:
+        f = open(input_file, 'rb')
+    except OSError as e:
+        print(f"Error reading file {input_file}: {e}")
+        return False
+
+    with f:
+        # The file is scanned front to back once; let the kernel read ahead further
+        fadvise(f.fileno(), 'POSIX_FADV_SEQUENTIAL')
+
+        # Extract sections straight from the page cache through a read-only mmap,
+        # so the file is never copied into one big userspace buffer. The mmap is not
+        # closed explicitly: the sections hold memoryviews into it, and it is
+        # released together with them.
+        try:
+            if os.fstat(f.fileno()).st_size == 0:
+                # mmap cannot map an empty file
+                content = b''
+            else:
+                content = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                    content.madvise(mmap.MADV_SEQUENTIAL)
+            sections = extract_sections(content, enable_spaghetti_detector)
+        except Exception as e:
+            print(f"Error reading file {input_file}: {e}")
+            return False
+
+        write_sections(output_file, sections, detect_line_terminator(content))
+
+    return True
+
+def is_already_converted(gcode_file: str, spaghetti_detector: bool) -> bool:
+    """
+    Check whether the file already starts in Orca-FlashForge order (header, metadata,
+    config, thumbnail, and the spaghetti detector commands if enabled), e.g. because
+    the script ran on it before. The landmarks are searched in a read-only mmap, so
+    a large header or thumbnail does not push them out of view, and find() skips
+    over the blocks in C.
+    """
+    try:
+        with open(gcode_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return False
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as content:
+                header_start = b"; HEADER_BLOCK_START"
+                if content[:len(header_start)] != header_start:
+                    return False
+
+                # Each landmark is searched for after the previous one, so they
+                # must all be present and in order
+                header_end = find_block_end(content, b"HEADER", 0)
+                if header_end < 0:
+                    return False
+                config_start = content.find(b"\n; CONFIG_BLOCK_START", header_end)
+                if config_start < 0:
+                    return False
+                config_end = find_block_end(content, b"CONFIG", config_start)
+                if config_end < 0:
+                    return False
+                thumbnail_start = content.find(b"\n; THUMBNAIL_BLOCK_START", config_end)
+                if thumbnail_start < 0:
+                    return False
+                thumbnail_end = find_block_end(content, b"THUMBNAIL", thumbnail_start)
+                if thumbnail_end < 0:
+                    return False
+                # The metadata is matched last: an unconverted file keeps it at the
+                # end of its body, and has already failed one of the find()s above
+                if METADATA_RE.search(content, header_end, config_start) is None:
+                    return False
+                return not spaghetti_detector or content.find(b"\n" + SPAGHETTI_DETECTOR_ON, thumbnail_end) >= 0
+    except OSError:
+        return False
+
+def create_backup(gcode_file: str, backup_file: str):
+    """
+    Keep the original G-code as backup_file. Hardlinking keeps the original bytes
+    without copying them, since the converted file replaces the original path
+    instead of overwriting it. Where that fails (e.g. across filesystems),
+    shutil.copyfile copies in the kernel (sendfile/fcopyfile/CopyFile).
+    """
+    if os.path.exists(backup_file):
+        os.remove(backup_file)
+    try:
+        os.link(gcode_file, backup_file)
+    except OSError:
+        shutil.copyfile(gcode_file, backup_file)
 
 def main():
     if len(sys.argv) < 2:
@@ -186,44 +416,50 @@ def main():
         print(f"Error: File {gcode_file} does not exist")
         sys.exit(1)
     
+    # Skip the full read and rewrite when the file is already converted
+    if is_already_converted(gcode_file, enable_spaghetti_detector):
+        print(f"[OrcaPost] {gcode_file} is already in Orca-FlashForge format, nothing to do")
+        return
+
     print(f"[OrcaPost] Converting G-code: {gcode_file}")
     
     # Create backup
     backup_file = gcode_file + ".backup"
     try:
-        with open(gcode_file, 'r', encoding='utf-8') as src:
-            with open(backup_file, 'w', encoding='utf-8') as dst:
-                dst.write(src.read())
+        create_backup(gcode_file, backup_file)
         print(f"[OrcaPost] Backup created: {backup_file}")
     except Exception as e:
         print(f"[OrcaPost] Warning: Could not create backup: {e}")
     
-    # Restructure the file
-    restructured_content = restructure_gcode(gcode_file)
-    
-    if restructured_content is None:
-        print("[OrcaPost] Error: Failed to restructure G-code")
-        sys.exit(1)
-    
-    # Write the restructured content back to the original file
+    # Restructure into a sibling temp file, then atomically move it over the original
+    temp_file = gcode_file + ".tmp"
     try:
-        with open(gcode_file, 'w', encoding='utf-8') as f:
-            f.write(restructured_content)
-        print(f"[OrcaPost] ✅ Successfully converted {gcode_file} to Orca-FlashForge format")
-        if enable_spaghetti_detector:
-            print("[OrcaPost] Spaghetti detector commands added ✅")
-        print("[OrcaPost] ETA and metadata should now display correctly on FlashForge printers")
+        converted = restructure_gcode_to(gcode_file, temp_file)
+
+        if not converted:
+            print("[OrcaPost] Error: Failed to restructure G-code")
+            sys.exit(1)
+
+        # Both the conversion and the backup are done reading the original, which
+        # from here on only lives on as the backup; let the kernel drop its pages
+        drop_cached_pages(gcode_file)
+        shutil.copymode(gcode_file, temp_file)
+        os.replace(temp_file, gcode_file)
     except Exception as e:
+        # os.replace is the last step above, so the original has not been touched
         print(f"[OrcaPost] Error writing file {gcode_file}: {e}")
-        if os.path.exists(backup_file):
+        print("[OrcaPost] Original file left unchanged")
+        if os.path.exists(temp_file):
             try:
-                with open(backup_file, 'r', encoding='utf-8') as src:
-                    with open(gcode_file, 'w', encoding='utf-8') as dst:
-                        dst.write(src.read())
-                print("[OrcaPost] Restored original file from backup")
-            except:
-                print("[OrcaPost] Failed to restore backup - manual intervention required")
+                os.remove(temp_file)
+            except OSError:
+                pass
         sys.exit(1)
 
+    print(f"[OrcaPost] ✅ Successfully converted {gcode_file} to Orca-FlashForge format")
+    if enable_spaghetti_detector:
+        print("[OrcaPost] Spaghetti detector commands added ✅")
+    print("[OrcaPost] ETA and metadata should now display correctly on FlashForge printers")
+
 if __name__ == "__main__":
     main()
@@ -278,6 +278,68 @@ class TestOrcaToFlashForgeConversion(unittest.TestCase):
             "Header block should contain a 'generated by' line"
         )
 
+    # ========== Spaghetti Detector Tests ==========
+
+    def test_spaghetti_detector_commands(self):
+        """Test that M981 commands precede the filament start/end gcode comments."""
+        expected = {
+            '; filament start gcode': 'M981 S1 P20000',
+            '; filament end gcode': 'M981 S0 P20000',
+        }
+
+        for marker, command in expected.items():
+            with self.subTest(marker=marker):
+                indices = [
+                    i for i, line in enumerate(self.converted_lines)
+                    if line.strip() == marker
+                ]
+                self.assertTrue(indices, f"Missing marker comment: {marker}")
+
+                for i in indices:
+                    self.assertTrue(
+                        self.converted_lines[i - 1].startswith(command),
+                        f"'{command}' should directly precede '{marker}'"
+                    )
+
+    def test_second_run_with_large_thumbnail_leaves_file_unchanged(self):
+        """Test that a converted file is recognised even when its blocks exceed the first 64 KB."""
+        large_gcode = os.path.join(self.script_dir, "temp_large_thumbnail.gcode")
+        large_backup = large_gcode + ".backup"
+        for path in (large_gcode, large_backup):
+            self.addCleanup(lambda path=path: os.path.exists(path) and os.remove(path))
+
+        # Pad the thumbnail so the executable body starts beyond the first 64 KB
+        with open(self.test_fixture, 'r', encoding='utf-8') as f:
+            original = f.read()
+        padding = "; " + "A" * 78 + "\n"
+        original = original.replace(
+            "; THUMBNAIL_BLOCK_START\n",
+            "; THUMBNAIL_BLOCK_START\n" + padding * 900,
+            1
+        )
+        with open(large_gcode, 'w', encoding='utf-8') as f:
+            f.write(original)
+
+        converted = None
+        for run in range(2):
+            result = subprocess.run(
+                [sys.executable, self.convert_script, large_gcode],
+                capture_output=True,
+                text=True
+            )
+            self.assertEqual(result.returncode, 0, f"Conversion failed: {result.stderr}")
+
+            with open(large_gcode, 'r', encoding='utf-8') as f:
+                content = f.read()
+            if run == 0:
+                converted = content
+
+        self.assertIn("nothing to do", result.stdout, "Second run should detect the converted file")
+        self.assertEqual(content, converted, "Second run should leave the converted file unchanged")
+
+        with open(large_backup, 'r', encoding='utf-8') as f:
+            self.assertEqual(f.read(), original, "Second run should not overwrite the backup")
+
     # ========== Content Preservation Tests ==========
 
     def test_no_data_loss(self):
@@ -298,6 +360,75 @@ class TestOrcaToFlashForgeConversion(unittest.TestCase):
             f"Significant difference in line count: original={len(original_lines)}, converted={len(converted_lines)}"
         )
 
+    def test_crlf_line_endings_preserved(self):
+        """Test that a CRLF file is converted without mixing in bare LF line endings."""
+        crlf_gcode = os.path.join(self.script_dir, "temp_crlf.gcode")
+        for path in (crlf_gcode, crlf_gcode + ".backup"):
+            self.addCleanup(lambda path=path: os.path.exists(path) and os.remove(path))
+
+        with open(self.test_fixture, 'rb') as f:
+            content = f.read()
+        with open(crlf_gcode, 'wb') as f:
+            f.write(content.replace(b'\n', b'\r\n'))
+
+        result = subprocess.run(
+            [sys.executable, self.convert_script, crlf_gcode],
+            capture_output=True,
+            text=True
+        )
+        self.assertEqual(result.returncode, 0, f"Conversion failed: {result.stderr}")
+
+        with open(crlf_gcode, 'rb') as f:
+            converted = f.read()
+
+        self.assertEqual(
+            converted.count(b'\n'),
+            converted.count(b'\r\n'),
+            "Every line of a CRLF file should still end in CRLF after conversion"
+        )
+        self.assertEqual(
+            converted.replace(b'\r\n', b'\n'),
+            self.converted_content.encode('utf-8'),
+            "A CRLF file should convert like its LF equivalent"
+        )
+
+    def test_second_run_leaves_file_unchanged(self):
+        """Test that converting an already converted file does not rewrite it."""
+        result = subprocess.run(
+            [sys.executable, self.convert_script, self.temp_gcode],
+            capture_output=True,
+            text=True
+        )
+        self.assertEqual(result.returncode, 0, f"Second conversion failed: {result.stderr}")
+
+        with open(self.temp_gcode, 'r', encoding='utf-8') as f:
+            second_content = f.read()
+
+        self.assertEqual(
+            self.converted_content,
+            second_content,
+            "Converting an already converted file should leave it unchanged"
+        )
+
+    def test_backup_matches_original(self):
+        """Test that the backup holds the original file and no temp file is left behind."""
+        self.assertTrue(os.path.exists(self.temp_backup), "Missing backup file")
+        self.assertFalse(
+            os.path.exists(self.temp_gcode + ".tmp"),
+            "Temporary output file should be moved over the original"
+        )
+
+        with open(self.test_fixture, 'rb') as f:
+            original_content = f.read()
+        with open(self.temp_backup, 'rb') as f:
+            backup_content = f.read()
+
+        self.assertEqual(
+            original_content,
+            backup_content,
+            "Backup file should be identical to the original G-code"
+        )
+
 
 def run_tests():
     """Run the test suite."""